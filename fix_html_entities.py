@@ -1,31 +1,23 @@
 """This script attempts to fix various problems found in PIM long descriptions."""
 
+import codecs
 import csv
+import io
+import os
 import re
 import sys
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from html import unescape
+from itertools import chain, islice
 from pathlib import Path
-from typing import Callable
+from typing import Any, Callable, Collection, Iterable, Iterator, TextIO
 
 from rich import print  # pylint: disable=redefined-builtin
 from rich.text import Text
 from tomlkit import load
-from tomlkit.items import AoT, Table
-
-
-def find_broken_entities(text: str, transformation: Table) -> set[str]:
-    """Takes a string and a transformation and returns a list of uniqe strings
-    that match the search pattern in the transformation."""
-
-    patt = re.compile(transformation["search_pattern"])  # type: ignore
-    found_entities: set[str] = set()
-    matches = patt.findall(text)
-    if not matches:
-        return found_entities
-
-    found_entities.update([x[0] for x in matches])
-    return found_entities
+from tomlkit.items import AoT
 
 
 def highlight_match(text: str, sep: str, markup: str) -> str:
@@ -34,37 +26,127 @@ def highlight_match(text: str, sep: str, markup: str) -> str:
     Then returns the new string with the markup."""
 
     markup = f"[{markup.strip('[]')}]"
-    before, mat, after = text.partition(sep)
-    if not mat:
+    if sep not in text:
         return text
-    if sep in after:
-        after = highlight_match(after, sep, markup)
-    long_desc_with_highlight = before + markup + mat + markup.replace("[", "[/", 1) + after
-    return long_desc_with_highlight
-
-
-def encoding_is_utf_8_with_bom(in_file: Path) -> bool:
-    """Takes a file path objects and returns True if the first 3 bytes in the file are EF BB BF.
-    Otherwise it returns False."""
-
-    with in_file.open("rb") as in_fb:
-        magic_bytes = in_fb.read(3)
-        if b"eDA" == magic_bytes:
-            # we are in Excel CSV territory which encodes CSV files with UTF with BOM (byte order mark)
-            # which means the first 3 bytes are \xEF \xBB \xBF = b'eDA'
-            return True
-    return False
+    return (markup + sep + markup.replace("[", "[/", 1)).join(text.split(sep))
+
+
+def open_csv(in_file: Path) -> TextIO:
+    """Takes a file path object and opens it for reading as text.
+    If the first 3 bytes in the file are EF BB BF the file is decoded as utf-8-sig, otherwise as utf-8.
+    The file is opened only once, the bytes are peeked from its buffer."""
+
+    in_fb = in_file.open("rb")
+    encoding = "utf-8"
+    if in_fb.peek(3)[:3] == codecs.BOM_UTF8:
+        # we are in Excel CSV territory which encodes CSV files with UTF with BOM (byte order mark)
+        encoding = "utf-8-sig"
+    return io.TextIOWrapper(in_fb, encoding=encoding)
+
+
+# the same few entities repeat across the product descriptions, so their unescaped values are kept
+cached_unescape = lru_cache(maxsize=4096)(unescape)
+
+
+def no_post_processing(text: str) -> str:
+    """Post processing function of transformations without a post_process, returns the text as is."""
+    return text
 
 
 def get_processing_func(post_process_str: str) -> Callable:
     """Takes a strig and returns a callable."""
     post_processing_funcs = {
-        "html.unescape": unescape,
+        "html.unescape": cached_unescape,
     }
     if post_process_str in post_processing_funcs:
         return post_processing_funcs[post_process_str]
     else:
-        return lambda x: x
+        return no_post_processing
+
+
+def build_multi_replace(replacements: dict[str, str]) -> Callable[[str], str] | None:
+    """Takes a dict of replacements and returns a callable that applies all of them to a string in one pass.
+    Uses a str.translate table if all keys are single characters, otherwise one alternation pattern.
+    Returns None if there are no replacements."""
+
+    if not replacements:
+        return None
+    if all(len(k) == 1 for k in replacements):
+        table = str.maketrans(replacements)
+        return lambda text: text.translate(table)
+    # longest keys first so that a key which is a prefix of another one doesn't shadow it
+    multi_re = re.compile("|".join(map(re.escape, sorted(replacements, key=len, reverse=True))))
+    return lambda text: multi_re.sub(lambda mat: replacements[mat.group(0)], text)
+
+
+def compile_replacement_template(template: str, pattern: re.Pattern) -> Callable[[re.Match], str] | None:
+    """Takes a replacement template and the pattern it's used with and returns a callable that expands
+    the template for a match, with the template parsed only once.
+    Only group references (\\1 to \\99, \\g<n>, \\g<name>) and text without backslashes are supported,
+    returns None for any other template so that re can expand it instead."""
+
+    # literal text before each group reference, and the referenced group
+    parts: list[tuple[str, str | int]] = []
+    pos = 0
+    for ref in re.finditer(r"\\(?:g<(\w+)>|(\d+))", template):
+        literal = template[pos : ref.start()]
+        name, number = ref.groups()
+        if "\\" in literal or (number and (number[0] == "0" or len(number) > 2)):
+            return None
+        if number or name.isdigit():
+            group = int(number or name)
+            if group > pattern.groups:
+                return None
+            parts.append((literal, group))
+        elif name in pattern.groupindex:
+            parts.append((literal, name))
+        else:
+            return None
+        pos = ref.end()
+    tail = template[pos:]
+    if "\\" in tail:
+        return None
+
+    def expand(mat: re.Match) -> str:
+        # unmatched groups expand to an empty string, same as in re
+        return "".join(literal + (mat.group(group) or "") for literal, group in parts) + tail
+
+    return expand
+
+
+def is_context_free(pattern: re.Pattern) -> bool:
+    """Takes a compiled pattern and returns True if what it matches, and its groups, depend only on
+    the matched text, so that the replacement of a match can be cached by its text.
+    Patterns with anchors, word boundaries, lookarounds or a '^' anywhere are treated as not context free."""
+
+    return re.search(r"\\[bBAZ]|[\^$]|\(\?<?[=!]", pattern.pattern) is None
+
+
+def compile_transformations(transformations: AoT) -> list[dict[str, Any]]:
+    """Takes a transformations AoT (toml array of tables) and returns a list of dicts
+    with the search patterns compiled and the post processing functions resolved,
+    so that they can be reused for every row of a csv."""
+
+    compiled = []
+    for transformation in transformations:
+        pattern = re.compile(transformation["search_pattern"])  # type: ignore
+        replacement_pattern = str(transformation["replacement_pattern"])
+        compiled.append(
+            {
+                "name": str(transformation["name"]),
+                "pattern": pattern,
+                "replacement_pattern": replacement_pattern,
+                "expand_replacement": compile_replacement_template(replacement_pattern, pattern),
+                "post_process": get_processing_func(transformation["post_process"]),  # type: ignore
+                "post_process_exceptions": frozenset(transformation["post_process_exceptions"]),  # type: ignore
+                "multi_replace": build_multi_replace(
+                    {str(k): str(v) for k, v in transformation["replacements"].items()}  # type: ignore
+                ),
+                # fixed shape tokens like the numeric html entities always get the same replacement
+                "replacement_cache": {} if is_context_free(pattern) else None,
+            }
+        )
+    return compiled
 
 
 def load_transformation_rules(in_file: str | Path) -> AoT:
@@ -77,86 +159,196 @@ def load_transformation_rules(in_file: str | Path) -> AoT:
     return rules["transformations"]  # type: ignore
 
 
-def apply_transformation(text: str, transformation: Table, highlight: bool = False) -> tuple[str, str]:
-    """Takes a string, a transformation and a highlight bool and applies the trasformation to the string,
+def apply_transformation(
+    text: str, transformation: dict[str, Any], highlight: bool = False, strip_markup: bool = True
+) -> tuple[str, str]:
+    """Takes a string, a compiled transformation and a highlight bool and applies the trasformation to the string,
     highlighting the matches and the replacements if hihghlight is True.
+    If strip_markup is False the string is known to have no rich.markup and is used as is.
     Returns the old text and the new text."""
 
-    search_pattern = re.compile(transformation["search_pattern"])  # type: ignore
+    search_pattern = transformation["pattern"]
     replacement_pattern = transformation["replacement_pattern"]
-    post_processing_func = get_processing_func(transformation["post_process"])  # type: ignore
+    post_processing_func = transformation["post_process"]
     post_processing_exceptions = transformation["post_process_exceptions"]
-    replacements = transformation["replacements"]
+    multi_replace = transformation["multi_replace"]
+    expand_replacement = transformation["expand_replacement"]
+    replacement_cache = transformation["replacement_cache"]
 
     # need to remove rich.markup in case the text was 'highlighed' before
 
     old_text = text
-    old_text = Text().from_markup(text).plain
-    new_text = old_text
-    matches = search_pattern.findall(old_text)
-    if not matches:
-        return text, text
-    for mat in matches:
-        replacement = mat[0]
-        if replacements:
-            for k, v in replacements.items():  # type: ignore
-                replacement = replacement.replace(k, v)
-        replacement = search_pattern.sub(replacement_pattern, replacement)
-        if replacement not in post_processing_exceptions:
-            replacement = post_processing_func(replacement)
+    if strip_markup and "[" in text:
+        old_text = Text().from_markup(text).plain
+    if multi_replace is None and post_processing_func is no_post_processing:
+        # nothing has to run in python for each match, re expands the template on its own
+        if highlight:
+            new_text, count = search_pattern.subn(f"[red u bold]{replacement_pattern}[/bold u red]", old_text)
+        else:
+            new_text, count = search_pattern.subn(replacement_pattern, old_text)
+        if not count:
+            return text, text
+        if highlight:
+            old_text = search_pattern.sub(r"[bold u red]\g<0>[/bold u red]", old_text)
+        return old_text, new_text
+
+    matched: set[str] = set()
+
+    def replace_match(mat: re.Match) -> str:
+        match_text = mat.group(0)
+        if highlight:
+            matched.add(match_text)
+        replacement = replacement_cache.get(match_text) if replacement_cache is not None else None
+        if replacement is None:
+            replacement = match_text
+            replaced = multi_replace(replacement) if multi_replace else replacement
+            if replaced == replacement and expand_replacement:
+                # the template is expanded from the match itself instead of matching the string again
+                replacement = expand_replacement(mat)
+            else:
+                replacement = search_pattern.sub(replacement_pattern, replaced)
+            if replacement not in post_processing_exceptions:
+                replacement = post_processing_func(replacement)
+            if replacement_cache is not None and len(replacement_cache) < 4096:
+                replacement_cache[match_text] = replacement
         if highlight:
             replacement = f"[red u bold]{replacement}[/bold u red]"
-            old_text = highlight_match(old_text, mat[0], "[bold u red]")
-        new_text = new_text.replace(mat[0], replacement)
-        # if mat[0] == "&#8201:":
-        #     print("OLD\n", text, "\n\nNEW\n", new_text)
-        #     sys.exit(1)
+        return replacement
+
+    new_text, count = search_pattern.subn(replace_match, old_text)
+    if not count:
+        return text, text
+    for mat in matched:
+        old_text = highlight_match(old_text, mat, "[bold u red]")
     return old_text, new_text
 
 
 def test_transformations(
-    in_file: str | Path, field_name: str, transformations: AoT, which_transformations: str | list[str] = "all"
+    in_file: str | Path,
+    field_name: str,
+    transformations: list[dict[str, Any]],
+    which_transformations: str | list[str] = "all",
 ) -> None:
-    """Function to test applying multiple transformations to a csv file."""
+    """Function to test applying multiple compiled transformations to a csv file."""
 
     if isinstance(in_file, str):
         in_file = Path(in_file)
     if isinstance(which_transformations, str):
         which_transformations = [which_transformations]
-
-    encoding = "utf-8"
-    if encoding_is_utf_8_with_bom(in_file):
-        encoding = "utf-8-sig"
-    with in_file.open("r", encoding=encoding) as inf:
-        reader = csv.DictReader(inf, dialect="excel")
+    which = frozenset(which_transformations)
+    transformations = [t for t in transformations if should_apply_transformation(t["name"], which)]
+
+    with open_csv(in_file) as inf:
+        reader = csv.reader(inf, dialect="excel")
+        header = next(reader, None)
+        if header is None:  # empty file
+            return
+        field_idx = header.index(field_name)
+        prod_idx = header.index("Product no.")
+        lang_idx = header.index("Language")
         for row in reader:
-            long_desc = row[field_name]
+            if not row:  # blank line
+                continue
+            long_desc = row[field_idx]
+            # only a previous transformation that changed the text adds highlight markup to it
+            highlighted = False
             for transform in transformations:
                 name = transform["name"]
-                transform_name = transform["name"]
-                if not should_apply_transformation(transform_name, which_transformations):
-                    continue
-                old_long_desc, long_desc = apply_transformation(long_desc, transform, highlight=True)
+                old_long_desc, long_desc = apply_transformation(
+                    long_desc, transform, highlight=True, strip_markup=highlighted
+                )
                 if old_long_desc != long_desc:
-                    print(f"Transformation: {name} | Product no.: {row['Product no.']} | Language: {row['Language']}")
+                    highlighted = True
+                    print(f"Transformation: {name} | Product no.: {row[prod_idx]} | Language: {row[lang_idx]}")
                     print("OLD", "\n", old_long_desc)
                     print("NEW", "\n", long_desc)
                     print("\n\n")
 
 
-def should_apply_transformation(transform_name: str, which_transformations: list[str]) -> bool:
-    """Takes a string and a list of strings and returns True if the string is in the list
-    or 'all' is in the list."""
+def should_apply_transformation(transform_name: str, which_transformations: Collection[str]) -> bool:
+    """Takes a string and a collection of strings and returns True if the string is in the collection
+    or 'all' is in the collection."""
 
     if transform_name in which_transformations or "all" in which_transformations:
         return True
     return False
 
 
+# bound finditer methods of the transformations of a worker process, set once by init_worker
+_worker_finditers: list[Callable[[str], Iterator[re.Match]]] = []  # pylint: disable=invalid-name
+
+
+def init_worker(transformations: list[dict[str, Any]]) -> None:
+    """Initializer of the worker processes. Keeps the finditer of every transformation once per process."""
+
+    global _worker_finditers  # pylint: disable=global-statement,invalid-name
+    _worker_finditers = [t["pattern"].finditer for t in transformations]
+
+
+def find_broken_entities_in_texts(
+    texts: list[str], finditers: list[Callable[[str], Iterator[re.Match]]]
+) -> list[set[str]]:
+    """Takes a list of strings and the bound finditer methods of the transformation patterns.
+    Returns a list with a set of unique whole matched strings for each transformation."""
+
+    broken_entities: list[set[str]] = [set() for _ in finditers]
+    # the strings found in each row are collected and merged every union_every rows
+    # with a single update call instead of one update per row
+    union_every = 10_000
+    found_lists: list[list[list[str]]] = [[] for _ in finditers]
+    for row_no, text in enumerate(texts, 1):
+        for accum, finditer in zip(found_lists, finditers):
+            row_broken_entities = [mat.group(0) for mat in finditer(text)]
+            if row_broken_entities:
+                accum.append(row_broken_entities)
+        if row_no % union_every == 0:
+            for found, accum in zip(broken_entities, found_lists):
+                found.update(*accum)
+                accum.clear()
+    for found, accum in zip(broken_entities, found_lists):
+        found.update(*accum)
+    return broken_entities
+
+
+def find_broken_entities_in_worker(texts: list[str]) -> list[set[str]]:
+    """Runs find_broken_entities_in_texts in a worker process started with init_worker."""
+
+    return find_broken_entities_in_texts(texts, _worker_finditers)
+
+
+def read_field_batches(in_file: Path, field_name: str, batch_size: int) -> Iterator[list[str]]:
+    """Takes a csv file path, a field name and a batch size.
+    Yields lists of at most batch_size values of the field."""
+
+    with open_csv(in_file) as inf:
+        reader = csv.reader(inf, dialect="excel")
+        header = next(reader, None)
+        if header is None:  # empty file
+            return
+        field_idx = header.index(field_name)
+        batch: list[str] = []
+        for row in reader:
+            if not row:
+                continue
+            batch.append(row[field_idx])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
 def find_broken_entities_in_file(
-    in_file: str | Path, field_name: str, transformations: AoT, which_transformations: str | list[str] = "all"
+    in_file: str | Path,
+    field_name: str,
+    transformations: list[dict[str, Any]],
+    which_transformations: str | list[str] = "all",
+    batch_size: int = 50_000,
+    max_workers: int | None = None,
 ) -> dict[str, list[str]]:
-    """Takes a file path or file string, a field name (str) and a transformations AoT (toml array of tables).
+    """Takes a file path or file string, a field name (str) and a list of compiled transformations.
+    The csv is read in batches of batch_size rows which are searched in parallel by max_workers processes
+    (os.cpu_count() by default). A file that fits in one batch is searched in the current process.
     Returns a dict of lists of unique strings that the transfomrations would have
     touched in the given field value of the csv."""
 
@@ -165,20 +357,41 @@ def find_broken_entities_in_file(
     if isinstance(which_transformations, str):
         which_transformations = [which_transformations]
 
-    encoding = "utf-8-sig" if encoding_is_utf_8_with_bom(in_file) else "utf-8"
-    broken_entities = defaultdict(set)
-    with in_file.open("r", encoding=encoding) as inf:
-        reader = csv.DictReader(inf, dialect="excel")
-        for row in reader:
-            for transform in transformations:
-                transform_name = transform["name"]
-                if not should_apply_transformation(transform_name, which_transformations):
-                    continue
-                row_broken_entities = find_broken_entities(row[field_name], transform)
-                if not row_broken_entities:
-                    continue
-                broken_entities[transform["name"]].update(row_broken_entities)
-    return {k: sorted(list(v)) for k, v in broken_entities.items()}
+    which = frozenset(which_transformations)
+    transformations = [t for t in transformations if should_apply_transformation(t["name"], which)]
+    if not transformations:
+        return {}
+    max_workers = max_workers or os.cpu_count() or 1
+    broken_entities: list[set[str]] = [set() for _ in transformations]
+
+    batches = read_field_batches(in_file, field_name, batch_size)
+    first_batches = list(islice(batches, 2))
+    if len(first_batches) < 2 or max_workers == 1:
+        finditers = [t["pattern"].finditer for t in transformations]
+        results: Iterable[list[set[str]]] = (
+            find_broken_entities_in_texts(texts, finditers) for texts in chain(first_batches, batches)
+        )
+        for batch_broken_entities in results:
+            for idx, found in enumerate(batch_broken_entities):
+                broken_entities[idx] |= found
+    else:
+        # only the search patterns are sent to the workers, the other compiled callables can't be pickled
+        worker_transformations = [{"name": t["name"], "pattern": t["pattern"]} for t in transformations]
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=init_worker, initargs=(worker_transformations,)
+        ) as executor:
+            # keep a bounded number of batches in flight so the whole csv isn't read into memory
+            pending = deque(
+                executor.submit(find_broken_entities_in_worker, texts)
+                for texts in chain(first_batches, islice(batches, 2 * max_workers - 2))
+            )
+            while pending:
+                batch_broken_entities = pending.popleft().result()
+                for idx, found in enumerate(batch_broken_entities):
+                    broken_entities[idx] |= found
+                for texts in islice(batches, 1):
+                    pending.append(executor.submit(find_broken_entities_in_worker, texts))
+    return {t["name"]: sorted(found) for t, found in zip(transformations, broken_entities) if found}
 
 
 def main():
@@ -195,12 +408,13 @@ def main():
         # "fix En:yyyy/An:yyyy standard",
     ]
     # which_transormations_to_apply = "all"
-    transformations = load_transformation_rules(rules_file)
+    transformations = compile_transformations(load_transformation_rules(rules_file))
 
     test_transformations(in_file, field_name, transformations, which_transormations_to_apply)
     broken_entities = find_broken_entities_in_file(in_file, field_name, transformations, which_transormations_to_apply)
     broken_entities = {
-        k: [{x: unescape(x.replace(":", ";"))} for x in v] if "invalid" in k else v for k, v in broken_entities.items()
+        k: [{x: cached_unescape(x.replace(":", ";"))} for x in v] if "invalid" in k else v
+        for k, v in broken_entities.items()
     }
     print(broken_entities)
 